@@ -4,12 +4,16 @@
 ##
 
 import asyncio
-import threading
 import json
+import math
+import struct
 from enum import Enum
 import bleak
 from bleak import BleakClient, BleakScanner
-from http.server import BaseHTTPRequestHandler, HTTPServer
+try:
+    import uvloop  # not available on Windows
+except ImportError:
+    uvloop = None
 
 # https://www.bluetooth.com/specifications/specs/gatt-specification-supplement-5/
 # https://gist.github.com/sam016/4abe921b5a9ee27f67b3686910293026
@@ -47,145 +51,182 @@ class Cycling_Speed_and_Cadence(Enum):
     Sensor_Location = "00002a5d-0000-1000-8000-00805f9b34fb"
     CSC_Measurement_Notify = "00002a5b-0000-1000-8000-00805f9b34fb"
 
+_DEVICE_NAME_UUID = Generic_Access_Profile.Device_Name.value
+_BATTERY_UUID = Battery_Service.Battery_Level.value
+_CSC_NOTIFY_UUID = Cycling_Speed_and_Cadence.CSC_Measurement_Notify.value
+
+# Flag, CumWheel, LastWheel
+_CSC_SPEED = struct.Struct('<BIH')
+# Flag, CumCrank, LastCrankTm
+_CSC_CAD = struct.Struct('<BHH')
+# Flag, CumWheel, LastWheel, CumCrank, LastCrankTm
+_CSC_BOTH = struct.Struct('<BIHHH')
+
+# each parser returns (flag, cum_wheel_rev, last_wheel_time, cum_crank_rev, last_crank_time)
+def _parse_speed(data):
+    flag, cum_wheel_rev, last_wheel_time = _CSC_SPEED.unpack_from(data)
+    return (flag, cum_wheel_rev, last_wheel_time, 0, 0)
+
+def _parse_cadence(data):
+    flag, cum_crank_rev, last_crank_time = _CSC_CAD.unpack_from(data)
+    return (flag, 0, 0, cum_crank_rev, last_crank_time)
+
+def _parse_speed_and_cadence(data):
+    return _CSC_BOTH.unpack_from(data)
+
+# indexed by Flag & 0x03
+_CSC_PARSERS = (None, _parse_speed, _parse_cadence, _parse_speed_and_cadence)
+
+# wheel rpm -> km/h for a 622 mm wheel
+_RPM_TO_KMPH = 0.622 * math.pi * 3.6 / 60.0
+
+# seconds without a notification before speed/cadence are reported as 0
+# (sensors notify about once a second while moving)
+_STALE_TIMEOUT = 3.0
+
+# only GET is served, like BaseHTTPRequestHandler without do_HEAD/do_POST
+_HTTP_501 = (b'HTTP/1.1 501 Not Implemented\r\n'
+             b'Content-Length: 0\r\n'
+             b'Connection: close\r\n\r\n')
+
+
+def _wheel_rpm(cum_wheel_rev, last_wheel_time, prev_cum_wheel_rev, prev_wheel_time):
+    delta_rotations = (cum_wheel_rev - prev_cum_wheel_rev) & 0xFFFFFFFF
+    time_delta = (last_wheel_time - prev_wheel_time) & 0xFFFF
+    if time_delta != 0 and prev_cum_wheel_rev != 0:
+        return 1024.0 * (delta_rotations * 60.0) / time_delta
+    return 0.0
+
+def _cadence(cum_crank_rev, last_crank_time, prev_cum_crank_rev, prev_crank_time, prev_rpm, staleness):
+    # returns (rpm, new_prev_rpm, new_staleness)
+    delta_rotations = (cum_crank_rev - prev_cum_crank_rev) & 0xFFFF
+    time_delta = (last_crank_time - prev_crank_time) & 0xFFFF
+
+    if time_delta != 0:
+        staleness = 0
+        time_mins = time_delta / 1024.0 / 60.0
+        rpm = delta_rotations / time_mins
+        prev_rpm = rpm
+    elif staleness < 2:
+        rpm = prev_rpm
+        staleness += 1
+    else:
+        rpm = 0.0
+
+    if rpm > 500:
+        rpm = 0.0
+    return (rpm, prev_rpm, staleness)
+
 
 class BK467:
     def __init__(self):
         self.client: BleakClient = None
-        self.data = [0,0,0,0,0,0,0]
+        self.flag = 0
+        self.mode = 'speed'
+        self.cum_wheel_rev = 0
+        self.last_wheel_time = 0
+        self.cum_crank_rev = 0
+        self.last_crank_time = 0
+        self.wheel_rpm = 0.0
+        self.wheel_kmph = 0.0
+        self.cadence_rpm = 0
+        self.last_notify_time = None
+        self.new_data = asyncio.Event()
+        self._loop = None
 
     @staticmethod
     async def scan_async():
         print("Searching BK467...")
-        return [d for d in await BleakScanner.discover() if d.name and "BK6" in d.name]
+        found = asyncio.get_running_loop().create_future()
+
+        def detection_callback(device, advertisement_data):
+            if not found.done() and device.name and "BK6" in device.name:
+                found.set_result(device)
+
+        async with BleakScanner(detection_callback=detection_callback):
+            return await found
 
     async def connect(self, mac_address):
-        client = BleakClient(mac_address, timeout=100000)
+        if self.client is not None: return
+        client = BleakClient(mac_address, timeout=20.0)
         await client.connect()
-        if self.client != None: return
         self.client = client
-        device_name = (await self.get_attr(Generic_Access_Profile.Device_Name)).decode()
+        self._loop = asyncio.get_running_loop()
+        device_name = (await client.read_gatt_char(_DEVICE_NAME_UUID)).decode()
         print(f"Connected: {client.address}, {device_name}")
-        await client.start_notify(Cycling_Speed_and_Cadence.CSC_Measurement_Notify.value, self.speed_and_cadence_notify)
+        await client.start_notify(_CSC_NOTIFY_UUID, self.speed_and_cadence_notify)
 
-    async def _check_device_connected(self):
-        if self.client == None:
+    def _check_device_connected(self):
+        if self.client is None:
             raise ValueError("Device not connected")
         
     def speed_and_cadence_notify(self, sender, data: bytearray):
-        self.data = data
+        parse = _CSC_PARSERS[data[0] & 0x03]
+        if parse is not None:
+            self._loop.call_soon_threadsafe(self._apply_parsed, parse(data))
         # print(data.hex())
         # print(data[2:-1].hex())
 
+    def _apply_parsed(self, parsed):
+        self.flag, self.cum_wheel_rev, self.last_wheel_time, self.cum_crank_rev, self.last_crank_time = parsed
+        self.mode = 'cadence' if self.flag & 0x02 else 'speed'
+        self.last_notify_time = self._loop.time()
+        if self.flag & 0x01:
+            self.wheel_rpm = self.calculate_wheel_rpm(self.cum_wheel_rev, self.last_wheel_time)
+        else:
+            self.wheel_rpm = 0.0
+            self.prev_combo_csc_cum_wheel_rev = 0
+            self.prev_combo_csc_wheel_time = 0
+        self.wheel_kmph = self.wheel_rpm * _RPM_TO_KMPH
+        if self.mode == "cadence":
+            self.cadence_rpm = self.calculate_cadence(self.cum_crank_rev, self.last_crank_time)
+        else:
+            self.cadence_rpm = 0
+        self.new_data.set()
+
+    # Sensor went quiet: report standstill without touching the rollover/staleness
+    # state, so the next notification is still compared with the last real sample.
+    def clear_readings(self):
+        self.last_notify_time = None
+        self.wheel_rpm = 0.0
+        self.wheel_kmph = 0.0
+        self.cadence_rpm = 0
+
     async def get_attr(self, key):
-        await self._check_device_connected()
+        self._check_device_connected()
         data = await self.client.read_gatt_char(key.value)
         return data
     
     async def get_battery_level(self):
-        await self._check_device_connected()
-        data = await self.client.read_gatt_char(Battery_Service.Battery_Level.value)
+        self._check_device_connected()
+        data = await self.client.read_gatt_char(_BATTERY_UUID)
         return int(data[0])
     
-    async def get_mode(self):
-        await self._check_device_connected()
-        is_speed_mode = (self.data[0] & 0x01) > 0
-        is_cadence_mode = (self.data[0] & 0x02) > 0
-        return 'cadence' if is_cadence_mode else 'speed'
-        
     prev_combo_csc_cum_wheel_rev = 0
     prev_combo_csc_wheel_time = 0
     
-    async def get_wheel_rpm(self):
-        await self._check_device_connected()
-        cum_wheel_rev = await self.get_cum_wheel_rev()
-        last_wheel_time = await self.get_last_wheel_time()
-        
-        wheel_rpm = 0.0
-        
-        delta_rotations = cum_wheel_rev - self.prev_combo_csc_cum_wheel_rev
-        time_delta = last_wheel_time - self.prev_combo_csc_wheel_time
-        if time_delta < 0:
-            time_delta += 65535
-        
-        if time_delta != 0 and self.prev_combo_csc_cum_wheel_rev != 0:
-            wheel_rpm = (2048.0 if False else 1024.0) * (delta_rotations * 60.0) / time_delta
-        
+    def calculate_wheel_rpm(self, cum_wheel_rev, last_wheel_time):
+        wheel_rpm = _wheel_rpm(cum_wheel_rev, last_wheel_time,
+                               self.prev_combo_csc_cum_wheel_rev, self.prev_combo_csc_wheel_time)
         self.prev_combo_csc_cum_wheel_rev = cum_wheel_rev
         self.prev_combo_csc_wheel_time = last_wheel_time
-        
         return wheel_rpm
     
-    async def get_wheel_speed(self):
-        rpm = await self.get_wheel_rpm()
-        wheel_circumference = 0.622 * 3.14159265359
-        rps = rpm / 60
-        mps = wheel_circumference * rps
-        kmph = mps * 3.6
-        return (kmph, rpm)
-    
-    async def get_cum_wheel_rev(self):
-        await self._check_device_connected()
-        if await self.get_mode() != "speed": return 0
-        return (self.data[4] << 24) + (self.data[3] << 16) + (self.data[2] << 8) + self.data[1]
-    
-    async def get_last_wheel_time(self):
-        await self._check_device_connected()
-        if await self.get_mode() != "speed": return 0
-        return (self.data[6] << 8) + self.data[5]
-
-    async def get_cadence(self):
-        await self._check_device_connected()
-        if await self.get_mode() != "cadence": return 0
-        return self.calculate_cadence(await self.get_cum_crank_rev(), await self.get_last_crank_time())
-    
-    async def get_cum_crank_rev(self):
-        await self._check_device_connected()
-        if await self.get_mode() != "cadence": return 0
-        return (self.data[2] << 8) + self.data[1]
-    
-    async def get_last_crank_time(self):
-        await self._check_device_connected()
-        if await self.get_mode() != "cadence": return 0
-        return (self.data[4] << 8) + self.data[3]
-    
     prev_cum_crank_rev = 0
     prev_crank_time = 0
     prev_crank_staleness = 0
     prev_rpm = 0.0
 
     def calculate_cadence(self, cum_crank_rev, last_crank_time):
-        delta_rotations = cum_crank_rev - self.prev_cum_crank_rev
-        if delta_rotations < 0:
-            delta_rotations += 65535
-
-        time_delta = last_crank_time - self.prev_crank_time
-        if time_delta < 0:
-            time_delta += 65535
-
-        if time_delta != 0:
-            self.prev_crank_staleness = 0
-            time_mins = time_delta / 1024.0 / 60.0
-            rpm = delta_rotations / time_mins
-            self.prev_rpm = rpm
-        elif time_delta == 0 and self.prev_crank_staleness < 2:
-            rpm = self.prev_rpm
-            self.prev_crank_staleness += 1
-        elif self.prev_crank_staleness >= 2:
-            rpm = 0.0
-
+        rpm, self.prev_rpm, self.prev_crank_staleness = _cadence(
+            cum_crank_rev, last_crank_time, self.prev_cum_crank_rev, self.prev_crank_time,
+            self.prev_rpm, self.prev_crank_staleness)
         self.prev_cum_crank_rev = cum_crank_rev
         self.prev_crank_time = last_crank_time
-
-        def check_rpm(rpm):
-            if rpm <= 500:
-                return rpm
-            else:
-                return 0.0
-            
-        return check_rpm(rpm)
+        return rpm
 
     async def test(self):
-        await self._check_device_connected()
+        self._check_device_connected()
 
 
 async def main():
@@ -193,76 +234,107 @@ async def main():
     PORT = 10000
 
     bk467 = BK467()
-    device_name = ""
-    battery_level = 0
-    json_data = "{}"
+    w_data = {
+        'device_name': "",
+        'battery_level': 0,
+        'mode': bk467.mode,
+        'cadence': 0,
+        'cum_crank_rev': 0,
+        'last_crank_time': 0,
+        'last_crank_time_sec': 0,
+        'cycling_speed': 0.0,
+        'cycling_rpm': 0.0,
+        'cum_wheel_rev': 0,
+        'last_wheel_time': 0,
+        'last_wheel_time_sec': 0
+    }
+    http_resp = b""
 
     async def on_connected():
-        nonlocal device_name, battery_level
         device_name = (await bk467.get_attr(Generic_Access_Profile.Device_Name)).decode()
         print("Device_Name:", device_name)
         battery_level = await bk467.get_battery_level()
         print("Battery_Level:", battery_level)
+        w_data['device_name'] = device_name
+        w_data['battery_level'] = battery_level
 
-    async def generate_json_str():
-        nonlocal device_name, battery_level
-        wheel_speed = await bk467.get_wheel_speed()
-        w_data = {
-            'device_name': device_name,
-            'battery_level': battery_level,
-            'mode': await bk467.get_mode(),
-            'cadence': await bk467.get_cadence(),
-            'cum_crank_rev': await bk467.get_cum_crank_rev(),
-            'last_crank_time': await bk467.get_last_crank_time(),
-            'last_crank_time_sec': int(await bk467.get_last_crank_time() / 1024),
-            'cycling_speed': wheel_speed[0],
-            'cycling_rpm': wheel_speed[1],
-            'cum_wheel_rev': await bk467.get_cum_wheel_rev(),
-            'last_wheel_time': await bk467.get_last_wheel_time(),
-            'last_wheel_time_sec': int(await bk467.get_last_wheel_time() / 1024)
-        }
-        json_string = json.dumps(w_data, indent=2)
-        return json_string
-
-    class MyHTTPRequestHandler(BaseHTTPRequestHandler):
-        def do_GET(self):
-            self.send_response(200)
-            self.send_header('Content-type', 'application/json')
-            self.end_headers()
-            self.wfile.write(json_data.encode())
-        def log_message(self, format, *args):
-            return
+    async def refresh_battery_level():
+        while True:
+            await asyncio.sleep(60)
+            try:
+                w_data['battery_level'] = await bk467.get_battery_level()
+            except Exception as e:
+                print("Battery_Level read failed:", e)
+                continue
+            bk467.new_data.set()
+
+    def generate_json_bytes():
+        w_data['mode'] = bk467.mode
+        w_data['cadence'] = bk467.cadence_rpm
+        w_data['cum_crank_rev'] = bk467.cum_crank_rev
+        w_data['last_crank_time'] = bk467.last_crank_time
+        w_data['last_crank_time_sec'] = bk467.last_crank_time >> 10
+        w_data['cycling_speed'] = bk467.wheel_kmph
+        w_data['cycling_rpm'] = bk467.wheel_rpm
+        w_data['cum_wheel_rev'] = bk467.cum_wheel_rev
+        w_data['last_wheel_time'] = bk467.last_wheel_time
+        w_data['last_wheel_time_sec'] = bk467.last_wheel_time >> 10
+        return json.dumps(w_data, separators=(',', ':')).encode()
+
+    async def handle_request(reader, writer):
+        try:
+            request = await reader.readuntil(b'\r\n\r\n')
+            method = request.split(b' ', 1)[0]
+            writer.write(http_resp if method == b'GET' else _HTTP_501)
+            await writer.drain()
+        except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+            try:
+                await writer.wait_closed()
+            except ConnectionError:
+                pass
 
     async def update():
-        nonlocal json_data
+        nonlocal http_resp
+        loop = asyncio.get_running_loop()
         while True:
-            json_data = await generate_json_str()
-            await asyncio.sleep(1)
-
-    def start_server():
-        server = HTTPServer((HOST, PORT), MyHTTPRequestHandler)
-        print(f'Starting server on {HOST}:{PORT}...')
-        try:
-            server.serve_forever()
-        except KeyboardInterrupt:
-            print('Server stopped.')
-            server.server_close()
-
-    while True:
-        devices = await bk467.scan_async()
-        if len(devices) != 0:
-            await bk467.connect(devices[0].address)
-            await on_connected()
-            break
-            
-    asyncio.create_task(update())
-    thread1 = threading.Thread(target=start_server)
-    thread1.start()
-
-    while True:
-        await asyncio.sleep(1)
-
-asyncio.run(main())
+            body = generate_json_bytes()
+            http_resp = (b'HTTP/1.1 200 OK\r\n'
+                         b'Content-Type: application/json\r\n'
+                         b'Content-Length: %d\r\n'
+                         b'Connection: close\r\n\r\n%s' % (len(body), body))
+            timeout = None
+            if bk467.last_notify_time is not None:
+                timeout = max(bk467.last_notify_time + _STALE_TIMEOUT - loop.time(), 0)
+            try:
+                await asyncio.wait_for(bk467.new_data.wait(), timeout)
+            except asyncio.TimeoutError:
+                if not bk467.new_data.is_set():
+                    bk467.clear_readings()
+            bk467.new_data.clear()
+
+    device = await bk467.scan_async()
+    await bk467.connect(device.address)
+    await on_connected()
+    battery_task = asyncio.create_task(refresh_battery_level())
+
+    server = await asyncio.start_server(handle_request, HOST, PORT)
+    print(f'Starting server on {HOST}:{PORT}...')
+    try:
+        async with server:
+            await update()
+    finally:
+        battery_task.cancel()
+
+if uvloop is None:
+    asyncio.run(main())
+elif hasattr(uvloop, 'run'):  # uvloop >= 0.18
+    uvloop.run(main())
+else:
+    asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+    asyncio.run(main())
 
 # # 00001800-0000-1000-8000-00805f9b34fb: Generic Access Profile: ["['read', 'write'],00002a00-0000-1000-8000-00805f9b34fb", "['read'],00002a01-0000-1000-8000-00805f9b34fb", "['read'],00002a04-0000-1000-8000-00805f9b34fb", "['read'],00002aa6-0000-1000-8000-00805f9b34fb"]
 # Device Name, Appearance, "Manufacturer Name String", Central Address Resolution